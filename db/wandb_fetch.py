@@ -1,140 +1,388 @@
 import wandb
 import pandas as pd
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 from datetime import datetime
 import time
+import os
+import argparse
+import random
+import threading
+import functools
+import contextlib
 import boto3
-import json
-import re  # Import regular expressions for extracting miner_id
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectionClosedError, EndpointConnectionError
+import orjson
+
+# PutRecords hard limits on the number of records and total payload size per request
+KINESIS_MAX_RECORDS_PER_BATCH = 500
+KINESIS_MAX_BYTES_PER_BATCH = 5 * 1024 * 1024
+
+# Number of PutRecords batches sent concurrently for one dataframe, one per core by default
+KINESIS_SEND_WORKERS = os.cpu_count() or 4
+
+# Region of the Kinesis stream
+KINESIS_REGION = "us-west-2"
+
+# Backoff between PutRecords retries, in seconds
+KINESIS_RETRY_BASE_DELAY = 0.1
+KINESIS_THROTTLED_RETRY_BASE_DELAY = 0.05
+KINESIS_RETRY_MAX_DELAY = 1.0
+KINESIS_RETRY_JITTER = 0.03
+
+# wandb project holding the validator runs
+WANDB_PROJECT = "openkaito/sn5-validators"
+
+# Default upper bound on runs being fetched from wandb at the same time, independent of the number
+# of fetch threads, so raising the thread count does not run into wandb API rate limits
+WANDB_MAX_CONCURRENT_FETCHES = 8
+
+# Number of history rows read per beta_scan_history page
+DEFAULT_HISTORY_PAGE_SIZE = 500
+
+# Columns of the metrics dataframe, in the order they are sent to Kinesis
+HISTORY_COLUMNS = ["run_name", "miner_id", "timestamp", "score", "loss", "top1_recall", "top3_recall"]
+
+# Map each wandb metric key prefix to its slot in a row's metrics: score, loss, top1_recall, top3_recall
+_PREFIX_MAP = {
+    "TextEmbeddingSynapse_raw_scores": 0,
+    "TextEmbeddingSynapse_losses": 1,
+    "TextEmbeddingSynapse_top1_recalls": 2,
+    "TextEmbeddingSynapse_top3_recalls": 3,
+}
+
+# Create a Kinesis client. One client is shared by all sender threads, so its connection pool is
+# sized to pool_size, the number of concurrent PutRecords calls, to give each call its own kept-alive
+# socket. It is built from its own Session because boto3's default session is not thread-safe and
+# clients may be created from sender threads
+def create_kinesis_client(pool_size=KINESIS_SEND_WORKERS):
+    config = Config(
+        max_pool_connections=pool_size,
+        retries={"max_attempts": 5, "mode": "adaptive"},
+        tcp_keepalive=True,
+    )
+    session = boto3.session.Session()
+    return session.client("kinesis", region_name=KINESIS_REGION, config=config)
+
+class SharedKinesisClient:
+    """
+    Kinesis client shared by the sender threads. When its connections break, the first thread to
+    notice swaps in a fresh client under the lock and every other thread picks up that same one.
+    """
+
+    def __init__(self, pool_size=KINESIS_SEND_WORKERS):
+        self._pool_size = pool_size
+        self._lock = threading.Lock()
+        self._client = create_kinesis_client(pool_size)
+
+    def put_records(self, **kwargs):
+        client = self._client
+        try:
+            return client.put_records(**kwargs)
+        except (EndpointConnectionError, ConnectionClosedError):
+            self._replace(client)
+            raise
+
+    def _replace(self, broken_client):
+        with self._lock:
+            # Another thread may already have replaced it
+            if self._client is broken_client:
+                self._client = create_kinesis_client(self._pool_size)
+
+# Compute the backoff before the next PutRecords attempt: exponential, capped, with a little jitter.
+# Throughput throttling clears within the shard's next second, so it backs off from a shorter base.
+def kinesis_retry_delay(attempt: int, throttled: bool):
+    base_delay = KINESIS_THROTTLED_RETRY_BASE_DELAY if throttled else KINESIS_RETRY_BASE_DELAY
+    return min(KINESIS_RETRY_MAX_DELAY, base_delay * 2 ** attempt) + random.random() * KINESIS_RETRY_JITTER
 
 # Define function to send records to Kinesis stream with retries in case of failure
 def put_records_to_kinesis(records_to_kinesis, kinesis_client, stream_name: str, retry_times: int):
-    failed_records = []
-    codes = []
-    err_msg = ""
+    attempt = 0
+    calls = 0
+    while True:
+        failed_records = []
+        codes = []
+        err_msg = ""
 
-    response = None
-    try:
-        # Attempt to send records to Kinesis
-        response = kinesis_client.put_records(
-            Records=records_to_kinesis,
-            StreamName=stream_name,
-        )
-    except Exception as e:
-        # If an error occurs, store the failed records and error message
-        failed_records = records_to_kinesis
-        err_msg = str(e)
-
-    # If no general failure, check if there are specific failed records
-    if not failed_records and response and response["FailedRecordCount"] > 0:
-        for idx, res in enumerate(response["Records"]):
-            # Skip successful records
-            if not res.get("ErrorCode"):
-                continue
-            # Store error codes and corresponding failed records
-            codes.append(res["ErrorCode"])
-            failed_records.append(records_to_kinesis[idx])
-
-        err_msg = "Individual error codes: " + ",".join(codes)
-
-    # Retry logic for failed records
-    if failed_records:
-        if retry_times > 0:
-            print(
-                "Some records failed while calling PutRecords to Kinesis stream, retrying. %s"
-                % (err_msg)
-            )
-            time.sleep(1)
-            # Recursive retry
-            put_records_to_kinesis(
-                failed_records, kinesis_client, stream_name, retry_times - 1
+        response = None
+        calls += 1
+        try:
+            # Attempt to send records to Kinesis
+            response = kinesis_client.put_records(
+                Records=records_to_kinesis,
+                StreamName=stream_name,
             )
+        except Exception as e:
+            # If an error occurs, store the failed records and error message. A SharedKinesisClient
+            # has already replaced itself if its connections broke, so the retry uses a fresh client
+            failed_records = records_to_kinesis
+            err_msg = str(e)
+            if isinstance(e, ClientError):
+                codes.append(e.response.get("Error", {}).get("Code", ""))
+
+        # If no general failure, check if there are specific failed records
+        if not failed_records and response and response["FailedRecordCount"] > 0:
+            for idx, res in enumerate(response["Records"]):
+                # Skip successful records
+                if not res.get("ErrorCode"):
+                    continue
+                # Store error codes and corresponding failed records
+                codes.append(res["ErrorCode"])
+                failed_records.append(records_to_kinesis[idx])
+
+            err_msg = "Individual error codes: " + ",".join(codes)
+
+        if not failed_records:
+            return
+
+        # Reset the backoff whenever some records made it through, only count attempts without progress
+        if len(failed_records) < len(records_to_kinesis):
+            attempt = 0
         else:
+            attempt += 1
+
+        # Retry logic for failed records
+        if attempt > retry_times:
             raise RuntimeError(
-                "Could not put records after %s attempts. %s"
-                % (str(retry_times), err_msg)
+                "Could not put records after %s attempts without progress, %s PutRecords calls in total. %s"
+                % (str(attempt), str(calls), err_msg)
             )
 
-# Function to extract miner_id from keys and fetch relevant metrics
-def extract_miner_id(key):
-    """
-    Extract miner_id from a key like 'TextEmbeddingSynapse_raw_scores.158'.
-    The miner_id is the number after the last period in the key.
-    """
-    match = re.search(r'\.(\d+)$', key)
-    if match:
-        return int(match.group(1))
+        print(
+            "Some records failed while calling PutRecords to Kinesis stream, retrying. %s"
+            % (err_msg)
+        )
+        throttled = bool(codes) and all(code == "ProvisionedThroughputExceededException" for code in codes)
+        time.sleep(kinesis_retry_delay(attempt, throttled))
+        records_to_kinesis = failed_records
+
+# Resolve a history key to the (slot, miner_id) it populates, or None if it is not a relevant metric
+def parse_metric_key(key):
+    # Keys look like 'TextEmbeddingSynapse_raw_scores.158', split off the miner_id once
+    prefix, _, suffix = key.rpartition('.')
+    slot = _PREFIX_MAP.get(prefix)
+    # isdecimal, unlike isdigit, rejects characters such as '²' that int() cannot parse
+    if slot is not None and suffix.isdecimal():
+        return slot, int(suffix)
     return None
 
+# Look up a run in the validator project, cached so that retrying or resuming a run_id does not
+# repeat the GraphQL round-trip. The script uses a single Api, so keying on it costs nothing
+@functools.lru_cache(maxsize=1024)
+def get_run(api, run_id):
+    return api.run(f"{WANDB_PROJECT}/{run_id}")
+
+# Load the runs for several run_ids with one paginated runs query, keyed by run_id
+def get_runs(api, run_ids):
+    runs = api.runs(WANDB_PROJECT, filters={"name": {"$in": list(run_ids)}})
+    return {run.id: run for run in runs}
+
 # Function to fetch data for a specific run_id from wandb, focusing on relevant metrics
-def fetch_run_data(api, run_id, start_time=None):
+def fetch_run_rows(api, run_id, start_time=None, page_size=DEFAULT_HISTORY_PAGE_SIZE, run=None, fetch_semaphore=None):
     """
-    Fetch metrics dataframe for a specific run_id, filtered by start_time and required metrics.
+    Yield the metrics rows of a specific run_id one at a time, filtered by start_time and required metrics.
+    page_size controls how many history rows each beta_scan_history page holds.
+    Pass an already loaded run to skip looking it up.
+    Pass a fetch_semaphore shared by several fetches to cap how many talk to wandb at once.
+    The semaphore is held until the generator is exhausted or closed, so close it when stopping early.
     """
-    print(f'Fetching data for run: {run_id}')
-    run = api.run(f"openkaito/sn5-validators/{run_id}")
-    
-    # Scan the run's history and filter by start_time if provided
-    history_data = []
-    for row in run.scan_history(page_size=1): 
-        timestamp = row.get('_timestamp', None)
-
-        if timestamp is not None:
-            if start_time is not None and timestamp < start_time:
-                break
-
-            # Initialize a dictionary to store the row data
-            filtered_row = {
-                "run_name": run_id,
-                "miner_id": None,
-                "timestamp": timestamp,
-                "score": None,
-                "loss": None,
-                "top1_recall": None,
-                "top3_recall": None
-            }
+    # Hold a wandb fetch slot for the whole scan, api.run and the history requests included
+    with fetch_semaphore if fetch_semaphore is not None else contextlib.nullcontext():
+        print(f'Fetching data for run: {run_id}')
+        if run is None:
+            run = get_run(api, run_id)
+
+        # beta_scan_history downloads the run's exported history once and iterates it locally
+        # instead of paging through the backend
+        history = run.beta_scan_history(page_size=page_size)
+
+        # Every history row of a run carries the same metric keys, so parse each key once and reuse the result
+        metric_keys = {}
+
+        # Metric slots of the current row, allocated once and reused for every row
+        metrics = [None, None, None, None]
+
+        # start_time is loop-invariant, so resolve it once and filter each row with a single comparison
+        min_timestamp = start_time if start_time is not None else float('-inf')
+
+        # Scan the run's history and filter by start_time if provided
+        for row in history:
+            timestamp = row.get('_timestamp')
+            # Row order is not guaranteed to be descending by timestamp, so skip old rows instead of stopping
+            if timestamp is None or timestamp < min_timestamp:
+                continue
+
+            # Reset the row's metric slots in place and only build the row dict once it is complete
+            miner_id = None
+            metrics[0] = metrics[1] = metrics[2] = metrics[3] = None
 
             # Iterate over the row's keys to find the relevant metrics
             for key, value in row.items():
-                if key.startswith("TextEmbeddingSynapse_raw_scores") and value is not None:
-                    filtered_row["score"] = value
-                    filtered_row["miner_id"] = extract_miner_id(key)
-                elif key.startswith("TextEmbeddingSynapse_losses") and value is not None:
-                    filtered_row["loss"] = value
-                    filtered_row["miner_id"] = extract_miner_id(key)
-                elif key.startswith("TextEmbeddingSynapse_top1_recalls") and value is not None:
-                    filtered_row["top1_recall"] = value
-                    filtered_row["miner_id"] = extract_miner_id(key)
-                elif key.startswith("TextEmbeddingSynapse_top3_recalls") and value is not None:
-                    filtered_row["top3_recall"] = value
-                    filtered_row["miner_id"] = extract_miner_id(key)
+                if value is None:
+                    continue
+                if key in metric_keys:
+                    metric = metric_keys[key]
+                else:
+                    metric = metric_keys[key] = parse_metric_key(key)
+                if metric is not None:
+                    slot, miner_id = metric
+                    metrics[slot] = value
 
             # Only append the row if all required fields (score, loss, etc.) have been populated
-            if all(filtered_row[field] is not None for field in ["score", "loss", "top1_recall", "top3_recall"]):
-                history_data.append(filtered_row)
+            score, loss, top1_recall, top3_recall = metrics
+            if score is not None and loss is not None and top1_recall is not None and top3_recall is not None:
+                yield {
+                    "run_name": run_id,
+                    "miner_id": miner_id,
+                    "timestamp": timestamp,
+                    "score": score,
+                    "loss": loss,
+                    "top1_recall": top1_recall,
+                    "top3_recall": top3_recall,
+                }
+
+# Collect metrics rows into a dataframe, for callers that need pandas operations on a run
+def as_dataframe(rows):
+    # Accumulate the rows column by column, one list per field, and build the DataFrame once at the end
+    history_columns = {field: [] for field in HISTORY_COLUMNS}
+    for filtered_row in rows:
+        for field, value in filtered_row.items():
+            history_columns[field].append(value)
 
     # Convert data to a Pandas DataFrame
-    metrics_dataframe = pd.DataFrame(history_data)
-    
-    return metrics_dataframe, run_id
-
-# Function to send the filtered wandb data to Kinesis
-def send_to_kinesis(metrics_dataframe, stream_name, kinesis_client):
-    records_to_kinesis = []
-    for index, row in metrics_dataframe.iterrows():
-        # Create a record for Kinesis with data and partition key
-        record = {
-            "Data": json.dumps(row.to_dict()) + "\n",
-            "PartitionKey": str(hash(row["run_name"]))
+    return pd.DataFrame(history_columns, copy=False)
+
+# Split records into PutRecords batches of at most 500 records and 5 MiB of data plus partition keys
+def batch_kinesis_records(records_to_kinesis):
+    batch = []
+    batch_bytes = 0
+    for record in records_to_kinesis:
+        record_bytes = len(record["Data"]) + len(record["PartitionKey"].encode())
+        if batch and (
+            len(batch) >= KINESIS_MAX_RECORDS_PER_BATCH
+            or batch_bytes + record_bytes > KINESIS_MAX_BYTES_PER_BATCH
+        ):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(record)
+        batch_bytes += record_bytes
+    if batch:
+        yield batch
+
+# Pick the number of threads fetching runs from wandb. Fetching is network-bound, so use 4 threads
+# per core with a floor of 8, but never more threads than runs
+def default_fetch_workers(run_count):
+    return max(1, min(run_count, max(8, (os.cpu_count() or 4) * 4)))
+
+# Build the Kinesis record for each metrics row as it arrives, Kinesis accepts bytes in Data.
+# When all rows belong to one run, pass its partition_key to skip the per-row run_name lookup.
+def build_kinesis_records(rows, partition_key=None):
+    if partition_key is not None:
+        for row in rows:
+            yield {
+                "Data": orjson.dumps(row, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n",
+                "PartitionKey": partition_key,
+            }
+        return
+
+    pk_cache = {}
+    for row in rows:
+        run_name = row["run_name"]
+        if run_name not in pk_cache:
+            pk_cache[run_name] = kinesis_partition_key(run_name)
+        yield {
+            "Data": orjson.dumps(row, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n",
+            "PartitionKey": pk_cache[run_name],
         }
-        records_to_kinesis.append(record)
 
-    # Send records to Kinesis using the put_records_to_kinesis function
-    put_records_to_kinesis(records_to_kinesis, kinesis_client, stream_name, 10)
+# Partition key for every record of a run
+def kinesis_partition_key(run_name):
+    return str(hash(run_name))
+
+# Function to send the filtered wandb data to Kinesis, returning the number of records sent.
+# rows is any iterable of metrics rows, such as fetch_run_rows, or a dataframe from as_dataframe.
+# Rows are serialized and batched as they are produced, and at most max_workers batches are in
+# flight at once, so memory stays bounded by the batch size rather than by the run's history.
+# Pass a shared executor to send the batches of several runs on one sender pool.
+def send_to_kinesis(rows, stream_name, kinesis_client, max_workers=KINESIS_SEND_WORKERS, partition_key=None, executor=None):
+    if isinstance(rows, pd.DataFrame):
+        # Nothing to send
+        if rows.empty:
+            return 0
+
+        # A dataframe of a single run gets its partition key computed once
+        run_names = rows["run_name"].unique()
+        if partition_key is None and len(run_names) == 1:
+            partition_key = kinesis_partition_key(run_names[0])
+
+        # Iterate the dataframe as plain tuples instead of building a Series per row, lazily so the
+        # records are serialized as they are batched
+        columns = list(rows.columns)
+        rows = (dict(zip(columns, values)) for values in rows.itertuples(index=False, name=None))
+
+    if executor is None:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return send_to_kinesis(rows, stream_name, kinesis_client, max_workers, partition_key, executor)
+
+    sent = 0
+    pending = set()
+    for batch in batch_kinesis_records(build_kinesis_records(rows, partition_key)):
+        if len(pending) >= max_workers:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                future.result()
+        pending.add(executor.submit(put_records_to_kinesis, batch, kinesis_client, stream_name, 10))
+        sent += len(batch)
+
+    for future in as_completed(pending):
+        future.result()
+
+    return sent
+
+# Fetch a run's metrics and stream them straight to Kinesis without materializing a dataframe
+def fetch_and_send_run(api, run_id, start_time, stream_name, kinesis_client, max_workers=KINESIS_SEND_WORKERS, executor=None, run=None, fetch_semaphore=None, page_size=DEFAULT_HISTORY_PAGE_SIZE):
+    partition_key = kinesis_partition_key(run_id)
+    rows = fetch_run_rows(api, run_id, start_time, page_size, run=run, fetch_semaphore=fetch_semaphore)
+    # Close the rows when sending fails part way, so the run's fetch slot is released right away
+    with contextlib.closing(rows):
+        return send_to_kinesis(rows, stream_name, kinesis_client, max_workers, partition_key, executor), run_id
+
+# argparse type for the worker, concurrency and page size flags, which must be at least 1
+def positive_int(value):
+    try:
+        number = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
 
 if __name__ == "__main__":
-    # Set up Kinesis client using boto3
-    kinesis_client = boto3.client("kinesis", region_name="us-west-2")
+    parser = argparse.ArgumentParser(description="Fetch wandb run metrics and send them to Kinesis")
+    parser.add_argument(
+        "--fetch-workers", type=positive_int, default=None,
+        help="threads fetching runs from wandb (default: min(runs, max(8, 4 * cpu_count)))",
+    )
+    parser.add_argument(
+        "--max-concurrent-fetches", type=positive_int, default=WANDB_MAX_CONCURRENT_FETCHES,
+        help="runs fetched from wandb at the same time (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--page-size", type=positive_int, default=DEFAULT_HISTORY_PAGE_SIZE,
+        help="history rows read per wandb history page (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--send-workers", type=positive_int, default=KINESIS_SEND_WORKERS,
+        help="threads sending PutRecords batches, shared by all runs (default: cpu_count)",
+    )
+    args = parser.parse_args()
+
+    # Shared by all fetches to cap how many runs talk to wandb at once
+    fetch_semaphore = threading.BoundedSemaphore(args.max_concurrent_fetches)
+
+    # Set up Kinesis client using boto3, with a connection per concurrent PutRecords call
+    kinesis_client = SharedKinesisClient(args.send_workers)
     stream_name = "your-kinesis-stream-name"
 
     # Set up WandB API
@@ -146,18 +394,34 @@ if __name__ == "__main__":
 
     all_metrics = []
 
-    # Use ThreadPoolExecutor to fetch multiple run data in parallel
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        futures = [executor.submit(fetch_run_data, api, run_id, start_time) for run_id in run_ids]
+    # Load all the runs up front in one query, runs it does not return are looked up individually.
+    # If the query fails, every run falls back to its own lookup so errors stay isolated per run
+    try:
+        runs = get_runs(api, run_ids)
+    except Exception as e:
+        print(f"Error preloading runs, looking them up individually: {e}")
+        runs = {}
+
+    fetch_workers = args.fetch_workers if args.fetch_workers is not None else default_fetch_workers(len(run_ids))
+
+    # Use ThreadPoolExecutor to fetch multiple run data in parallel. The PutRecords batches of all
+    # runs go to a second, shared pool, so fetching history and sending to Kinesis overlap
+    with ThreadPoolExecutor(max_workers=args.send_workers) as send_pool, \
+            ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+        # Each run's rows are sent to Kinesis as they are fetched
+        futures = [
+            executor.submit(
+                fetch_and_send_run, api, run_id, start_time, stream_name, kinesis_client, args.send_workers, send_pool,
+                run=runs.get(run_id), fetch_semaphore=fetch_semaphore, page_size=args.page_size,
+            )
+            for run_id in run_ids
+        ]
 
         for future in as_completed(futures):
             try:
-                # Process the fetched data for each run
-                metrics_dataframe, run_id = future.result()
-                print(f"Metrics for run {run_id}:\n", metrics_dataframe)
-
-                # Send the fetched data to Kinesis
-                send_to_kinesis(metrics_dataframe, stream_name, kinesis_client)
+                # Process the result for each run
+                sent, run_id = future.result()
+                print(f"Sent {sent} metrics records for run {run_id}")
 
             except Exception as e:
                 print(f"Error fetching data for run: {e}")
@@ -0,0 +1,287 @@
+import importlib
+import json
+import os
+import sys
+import threading
+import types
+import unittest
+from concurrent.futures import ThreadPoolExecutor, wait
+from unittest import mock
+
+
+# Stand in for the script's third-party dependencies that are not installed, so the fetch and
+# send logic is exercised anywhere. Installed packages are used as they are
+def _stub_missing_modules():
+    def missing(name):
+        try:
+            importlib.import_module(name)
+            return False
+        except ImportError:
+            return True
+
+    if missing("wandb"):
+        sys.modules["wandb"] = types.ModuleType("wandb")
+
+    if missing("pandas"):
+        pandas = types.ModuleType("pandas")
+        pandas.DataFrame = type("DataFrame", (), {})
+        sys.modules["pandas"] = pandas
+
+    if missing("orjson"):
+        orjson = types.ModuleType("orjson")
+        orjson.OPT_SERIALIZE_NUMPY = 0
+        orjson.dumps = lambda obj, option=0: json.dumps(obj).encode()
+        sys.modules["orjson"] = orjson
+
+    if missing("boto3") or missing("botocore"):
+        boto3 = types.ModuleType("boto3")
+        boto3.session = types.SimpleNamespace(Session=lambda: None)
+        botocore = types.ModuleType("botocore")
+        config = types.ModuleType("botocore.config")
+        config.Config = lambda **kwargs: kwargs
+        exceptions = types.ModuleType("botocore.exceptions")
+
+        class BotoCoreError(Exception):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, *kwargs.values())
+
+        exceptions.ClientError = type("ClientError", (BotoCoreError,), {})
+        exceptions.ConnectionClosedError = type("ConnectionClosedError", (BotoCoreError,), {})
+        exceptions.EndpointConnectionError = type("EndpointConnectionError", (BotoCoreError,), {})
+        sys.modules.update({
+            "boto3": boto3,
+            "botocore": botocore,
+            "botocore.config": config,
+            "botocore.exceptions": exceptions,
+        })
+
+
+_stub_missing_modules()
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "db"))
+import wandb_fetch  # noqa: E402
+
+
+class FakeRun:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def beta_scan_history(self, page_size):
+        return iter(self.rows)
+
+
+class FakeApi:
+    def __init__(self, rows):
+        self.rows = rows
+        self.fetched = []
+        self.lock = threading.Lock()
+
+    def run(self, path):
+        with self.lock:
+            self.fetched.append(path.rsplit("/", 1)[-1])
+        return FakeRun(self.rows)
+
+
+class FailingKinesisClient:
+    def put_records(self, Records, StreamName):
+        raise RuntimeError("stream does not exist")
+
+
+class ScriptedKinesisClient:
+    """Fails PutRecords records by index: call n fails the records in failures[n] with error_code."""
+
+    def __init__(self, failures, error_code="InternalFailure"):
+        self.failures = list(failures)
+        self.error_code = error_code
+        self.calls = []
+
+    def put_records(self, Records, StreamName):
+        self.calls.append(len(Records))
+        failing = self.failures.pop(0) if self.failures else ()
+        results = [
+            {"ErrorCode": self.error_code} if idx in failing else {"SequenceNumber": str(idx)}
+            for idx in range(len(Records))
+        ]
+        return {"FailedRecordCount": len(failing), "Records": results}
+
+
+def kinesis_records(count, data_size=1):
+    return [{"Data": b"x" * data_size, "PartitionKey": str(idx)} for idx in range(count)]
+
+
+def history_rows(count):
+    return [
+        {
+            "_timestamp": timestamp,
+            "TextEmbeddingSynapse_raw_scores.1": 0.5,
+            "TextEmbeddingSynapse_losses.1": 0.1,
+            "TextEmbeddingSynapse_top1_recalls.1": 0.7,
+            "TextEmbeddingSynapse_top3_recalls.1": 0.9,
+        }
+        for timestamp in range(count)
+    ]
+
+
+class FetchRunRowsTest(unittest.TestCase):
+    def test_yields_only_complete_rows(self):
+        rows = history_rows(2)
+        # The second row misses its loss, which must not carry over from the first row
+        del rows[1]["TextEmbeddingSynapse_losses.1"]
+        rows[1]["TextEmbeddingSynapse_raw_scores.²"] = 0.3
+
+        fetched = list(wandb_fetch.fetch_run_rows(FakeApi(rows), "r0"))
+
+        self.assertEqual(fetched, [{
+            "run_name": "r0",
+            "miner_id": 1,
+            "timestamp": 0,
+            "score": 0.5,
+            "loss": 0.1,
+            "top1_recall": 0.7,
+            "top3_recall": 0.9,
+        }])
+
+
+class FetchAndSendRunTest(unittest.TestCase):
+    def setUp(self):
+        original_delay = wandb_fetch.kinesis_retry_delay
+        wandb_fetch.kinesis_retry_delay = lambda attempt, throttled: 0
+        self.addCleanup(setattr, wandb_fetch, "kinesis_retry_delay", original_delay)
+
+    def test_failed_send_releases_fetch_slot(self):
+        # History longer than the batches in flight, so each run's generator is suspended when its send fails
+        api = FakeApi(history_rows(4 * wandb_fetch.KINESIS_MAX_RECORDS_PER_BATCH))
+        run_ids = ["r0", "r1", "r2", "r3"]
+        fetch_semaphore = threading.BoundedSemaphore(2)
+
+        fetch_pool = ThreadPoolExecutor(max_workers=len(run_ids))
+        send_pool = ThreadPoolExecutor(max_workers=1)
+        try:
+            # Keep every future alive, as the main block does
+            futures = [
+                fetch_pool.submit(
+                    wandb_fetch.fetch_and_send_run, api, run_id, None, "stream", FailingKinesisClient(), 1, send_pool,
+                    fetch_semaphore=fetch_semaphore,
+                )
+                for run_id in run_ids
+            ]
+            done, not_done = wait(futures, timeout=10)
+
+            self.assertEqual(not_done, set())
+            for future in futures:
+                self.assertIsInstance(future.exception(), RuntimeError)
+            self.assertEqual(sorted(api.fetched), run_ids)
+        finally:
+            # Unblock any fetch still waiting for a slot so the pools can shut down
+            for _ in run_ids:
+                try:
+                    fetch_semaphore.release()
+                except ValueError:
+                    break
+            fetch_pool.shutdown(wait=False)
+            send_pool.shutdown(wait=False)
+
+
+class PutRecordsToKinesisTest(unittest.TestCase):
+    def setUp(self):
+        self.delays = []
+        sleep = mock.patch.object(wandb_fetch.time, "sleep", self.delays.append)
+        jitter = mock.patch.object(wandb_fetch.random, "random", lambda: 0.0)
+        sleep.start()
+        jitter.start()
+        self.addCleanup(sleep.stop)
+        self.addCleanup(jitter.stop)
+
+    def test_partial_progress_resets_attempts(self):
+        # Every call gets one more record through, so it takes more calls than retry_times allows
+        client = ScriptedKinesisClient([{0, 1, 2}, {0, 1}, {0}])
+
+        wandb_fetch.put_records_to_kinesis(kinesis_records(4), client, "stream", retry_times=1)
+
+        self.assertEqual(client.calls, [4, 3, 2, 1])
+
+    def test_gives_up_after_retry_times_without_progress(self):
+        client = ScriptedKinesisClient([{0, 1}] * 10)
+
+        with self.assertRaisesRegex(RuntimeError, "after 3 attempts without progress, 3 PutRecords calls"):
+            wandb_fetch.put_records_to_kinesis(kinesis_records(2), client, "stream", retry_times=2)
+
+        self.assertEqual(client.calls, [2, 2, 2])
+
+    def test_throttled_records_back_off_less(self):
+        throttled = ScriptedKinesisClient([{0}], error_code="ProvisionedThroughputExceededException")
+        wandb_fetch.put_records_to_kinesis(kinesis_records(1), throttled, "stream", retry_times=1)
+        failed = ScriptedKinesisClient([{0}])
+        wandb_fetch.put_records_to_kinesis(kinesis_records(1), failed, "stream", retry_times=1)
+
+        self.assertEqual(self.delays, [
+            wandb_fetch.KINESIS_THROTTLED_RETRY_BASE_DELAY * 2,
+            wandb_fetch.KINESIS_RETRY_BASE_DELAY * 2,
+        ])
+        self.assertLess(self.delays[0], self.delays[1])
+
+
+class UnreachableKinesisClient:
+    def __init__(self):
+        self.calls = 0
+
+    def put_records(self, Records, StreamName):
+        self.calls += 1
+        raise wandb_fetch.EndpointConnectionError(endpoint_url="https://kinesis.us-west-2.amazonaws.com")
+
+
+class SharedKinesisClientTest(unittest.TestCase):
+    def setUp(self):
+        sleep = mock.patch.object(wandb_fetch.time, "sleep", lambda seconds: None)
+        sleep.start()
+        self.addCleanup(sleep.stop)
+
+    def test_broken_client_is_replaced_once(self):
+        broken = UnreachableKinesisClient()
+        replacement = ScriptedKinesisClient([])
+        created = [broken, replacement]
+        pool_sizes = []
+
+        def create_kinesis_client(pool_size):
+            pool_sizes.append(pool_size)
+            return created.pop(0)
+
+        with mock.patch.object(wandb_fetch, "create_kinesis_client", create_kinesis_client):
+            shared = wandb_fetch.SharedKinesisClient(pool_size=3)
+            wandb_fetch.put_records_to_kinesis(kinesis_records(2), shared, "stream", retry_times=1)
+            wandb_fetch.put_records_to_kinesis(kinesis_records(2), shared, "stream", retry_times=1)
+
+        # Only the first batch hit the broken client, and the replacement keeps the pool size
+        self.assertEqual(broken.calls, 1)
+        self.assertEqual(replacement.calls, [2, 2])
+        self.assertEqual(pool_sizes, [3, 3])
+
+
+class BatchKinesisRecordsTest(unittest.TestCase):
+    def batch_sizes(self, records):
+        return [len(batch) for batch in wandb_fetch.batch_kinesis_records(records)]
+
+    def test_splits_at_record_limit(self):
+        self.assertEqual(self.batch_sizes(kinesis_records(1201)), [500, 500, 201])
+
+    def test_splits_at_byte_limit(self):
+        # Just under 1 MiB of data plus partition key, so five records fill a 5 MiB batch
+        records = kinesis_records(12, data_size=1024 * 1024 - 16)
+        self.assertEqual(self.batch_sizes(records), [5, 5, 2])
+
+    def test_empty_input(self):
+        self.assertEqual(self.batch_sizes([]), [])
+
+
+class PositiveIntTest(unittest.TestCase):
+    def test_accepts_one_and_above(self):
+        self.assertEqual(wandb_fetch.positive_int("1"), 1)
+        self.assertEqual(wandb_fetch.positive_int("16"), 16)
+
+    def test_rejects_zero_negative_and_non_int(self):
+        for value in ("0", "-2", "two"):
+            with self.assertRaises(wandb_fetch.argparse.ArgumentTypeError):
+                wandb_fetch.positive_int(value)
+
+
+if __name__ == "__main__":
+    unittest.main()